@@ -1,9 +1,13 @@
 # Example untyped Python file for testing
 # This file intentionally has no type annotations to demonstrate the MCP server
 
+from operator import attrgetter
+
+_price = attrgetter("price")
+
 def calculate_total(items, tax_rate):
     """Calculate total price including tax."""
-    subtotal = sum(item.price for item in items)
+    subtotal = sum(map(_price, items))
     tax = subtotal * tax_rate
     return subtotal + tax
 
@@ -12,6 +16,8 @@ def filter_items(items, min_price):
     return [item for item in items if item.price >= min_price]
 
 class Item:
+    __slots__ = ("name", "price")
+    
     def __init__(self, name, price) -> None:
         self.name = name
         self.price = price
@@ -31,13 +37,17 @@ def generate_receipt(items, tax_rate=None) -> str:
     if tax_rate is None:
         tax_rate = DEFAULT_TAX_RATE
     
-    total = calculate_total(items, tax_rate)
     lines: list[str] = []
+    subtotal = 0
     
     for item in items:
         lines.append(f"{item.name}: {CURRENCY_SYMBOL}{item.price:.2f}")
+        subtotal += item.price
+    
+    tax = subtotal * tax_rate
+    total = subtotal + tax
     
-    lines.append(f"Tax ({tax_rate*100}%): {CURRENCY_SYMBOL}{total - sum(item.price for item in items):.2f}")
+    lines.append(f"Tax ({tax_rate*100}%): {CURRENCY_SYMBOL}{tax:.2f}")
     lines.append(f"Total: {CURRENCY_SYMBOL}{total:.2f}")
     
     return "\n".join(lines)
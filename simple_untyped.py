@@ -6,13 +6,7 @@ def multiply(x: int, y: int):
     return result
 
 def process_data(items: list[bool | float | int | str]):
-    output = []
-    for item in items:
-        if isinstance(item, int):
-            output.append(item * 2)
-        else:
-            output.append(str(item))
-    return output
+    return [item * 2 if isinstance(item, int) else str(item) for item in items]
 
 name = "test"
 age = 25
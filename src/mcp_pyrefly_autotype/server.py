@@ -1,10 +1,20 @@
 import asyncio
+import hashlib
 import json
 import os
+import re
+import shutil
 import subprocess
 import tempfile
+import time
+from collections import OrderedDict, deque
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, Final, Iterator, List, NamedTuple, Optional, Sequence
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 from mcp.server.models import InitializationOptions
 import mcp.types as types
@@ -14,59 +24,328 @@ import mcp.server.stdio
 
 server = Server("mcp-pyrefly-autotype")
 
+def _resolve_pyrefly() -> List[str]:
+    """Locate the pyrefly executable once so calls can skip the `uv run` wrapper.
+    
+    Falls back to `uv run pyrefly` when no executable can be found.
+    """
+    found = shutil.which("pyrefly")
+    if found:
+        return [found]
+    
+    try:
+        result = subprocess.run(
+            ["uv", "run", "--no-sync", "python", "-c",
+             "import shutil; print(shutil.which('pyrefly') or '')"],
+            capture_output=True,
+            text=True,
+            timeout=30
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return ["uv", "run", "pyrefly"]
+    
+    found = result.stdout.strip()
+    if result.returncode == 0 and found:
+        return [found]
+    return ["uv", "run", "pyrefly"]
+
+def _resolve_pyrefly_version(pyrefly_cmd: List[str]) -> str:
+    """Return `pyrefly --version` output, or "unknown" if it cannot be run."""
+    try:
+        result = subprocess.run(
+            [*pyrefly_cmd, "--version"],
+            capture_output=True,
+            text=True,
+            timeout=30
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return "unknown"
+    
+    return result.stdout.strip() if result.returncode == 0 and result.stdout.strip() else "unknown"
+
+# Command prefix for invoking Pyrefly, resolved once at import
+_PYREFLY_CMD = _resolve_pyrefly()
+# Cached analysis results are only valid for the Pyrefly that produced them
+_PYREFLY_VERSION = _resolve_pyrefly_version(_PYREFLY_CMD)
+
+def _batch_size_from_env() -> int:
+    """Read PYREFLY_AUTOTYPE_BATCH_SIZE, clamped to at least 1."""
+    raw = os.environ.get("PYREFLY_AUTOTYPE_BATCH_SIZE", "64")
+    try:
+        return max(1, int(raw))
+    except ValueError:
+        raise ValueError(f"PYREFLY_AUTOTYPE_BATCH_SIZE must be an integer, got {raw!r}") from None
+
+# Maximum number of analyze requests AnalysisBatcher hands to analyze_files at once
+BATCH_SIZE = _batch_size_from_env()
+# How long to wait for more analyze requests before starting a batch
+BATCH_DEBOUNCE_SECONDS = 0.025
+
+# How much streamed Pyrefly output is kept for the pyrefly_output field
+STREAM_TAIL_CHARS = 4096
+# Read size for streamed Pyrefly stdout; lines may be longer than this
+STREAM_CHUNK_BYTES = 64 * 1024
+
+# Marks a directory as one AnalysisCache created; its mtime records the last use
+_CACHE_MARKER = ".mcp-pyrefly-autotype"
+# Other versions' cached results are removed once unused for this long
+CACHE_MAX_AGE_SECONDS = 30 * 24 * 60 * 60
+
+# Linux FICLONE ioctl: share the source file's extents instead of copying bytes
+_FICLONE = 0x40049409
+
+# Directories never searched for Python files
+_SKIP_DIRS = frozenset({'__pycache__', 'node_modules', '.git', '.venv'})
+
+# Whole lines of Pyrefly output that mention "type" and "function" or
+# "variable", in any order
+_ANALYSIS_RE = re.compile(
+    r"^(?=.*type)(?=.*(?:function|variable)).*$",
+    re.IGNORECASE | re.MULTILINE
+)
+
+class FileRef(NamedTuple):
+    """A file's path together with its content, read once at the tool boundary."""
+    path: str
+    data: bytes
+    digest: bytes
+
+def _load(path: str) -> FileRef:
+    """Read a file once and fingerprint its content."""
+    with open(path, "rb") as f:
+        data = f.read()
+    return FileRef(path, data, hashlib.sha256(data).digest())
+
+class AnalysisCache:
+    """LRU cache of analysis results keyed by file content and Pyrefly version.
+    
+    When a directory is given, results are also persisted there as JSON so
+    they survive server restarts. Entries live under a per-version
+    subdirectory, so upgrading Pyrefly starts from an empty cache. The
+    first write removes version subdirectories this cache created that
+    have gone unused for CACHE_MAX_AGE_SECONDS; anything else in the
+    directory is left alone. Within a version the on-disk cache is not
+    size limited.
+    """
+    
+    def __init__(self, maxsize: int = 512, directory: Optional[str] = None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple[bytes, str], Dict[str, Any]] = OrderedDict()
+        self._pruned = False
+        self._marked: set[str] = set()
+    
+    def get(self, key: tuple[bytes, str]) -> Optional[Dict[str, Any]]:
+        """Return the cached result for key, or None on a miss."""
+        result = self._entries.get(key)
+        if result is not None:
+            self._entries.move_to_end(key)
+        else:
+            result = self._read(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self._remember(key, result)
+        
+        self.hits += 1
+        return result
+    
+    def put(self, key: tuple[bytes, str], result: Dict[str, Any]) -> None:
+        """Store a result, evicting the least recently used entry if full."""
+        self._remember(key, result)
+        self._write(key, result)
+    
+    def _remember(self, key: tuple[bytes, str], result: Dict[str, Any]) -> None:
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+    
+    def _path(self, key: tuple[bytes, str]) -> Optional[str]:
+        digest, version = key
+        # Without a known version a persisted result could outlive an upgrade
+        if self.directory is None or version == "unknown":
+            return None
+        hex_digest = digest.hex()
+        return os.path.join(self.directory, _version_dir(version), hex_digest[:2], f"{hex_digest}.json")
+    
+    def _mark_used(self, version: str) -> None:
+        """Record that this version's subdirectory is in use, once per instance."""
+        if version in self._marked:
+            return
+        assert self.directory is not None
+        version_dir = os.path.join(self.directory, _version_dir(version))
+        try:
+            os.makedirs(version_dir, exist_ok=True)
+            with open(os.path.join(version_dir, _CACHE_MARKER), "a"):
+                pass
+            os.utime(os.path.join(version_dir, _CACHE_MARKER))
+        except OSError:
+            return
+        self._marked.add(version)
+    
+    def _prune(self, version: str) -> None:
+        """Remove other versions' subdirectories that have gone unused."""
+        assert self.directory is not None
+        keep = _version_dir(version)
+        cutoff = time.time() - CACHE_MAX_AGE_SECONDS
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.name == keep or not entry.is_dir(follow_symlinks=False):
+                        continue
+                    # Only directories carrying the marker were created by this cache
+                    try:
+                        last_used = os.stat(os.path.join(entry.path, _CACHE_MARKER)).st_mtime
+                    except OSError:
+                        continue
+                    if last_used < cutoff:
+                        shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            pass
+    
+    def _read(self, key: tuple[bytes, str]) -> Optional[Dict[str, Any]]:
+        path = self._path(key)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                result = json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        self._mark_used(key[1])
+        return result
+    
+    def _write(self, key: tuple[bytes, str], result: Dict[str, Any]) -> None:
+        path = self._path(key)
+        if path is None:
+            return
+        self._mark_used(key[1])
+        if not self._pruned:
+            self._pruned = True
+            self._prune(key[1])
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(result, f)
+                # Atomic, so concurrent readers never see a partial entry
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError:
+            # The on-disk cache is best effort
+            pass
+
+def _version_dir(version: str) -> str:
+    """Directory name for one Pyrefly version's cached results."""
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", version)
+
+def _default_cache_dir() -> Optional[str]:
+    """Where persisted analysis results live; an empty override disables it."""
+    override = os.environ.get("PYREFLY_AUTOTYPE_CACHE_DIR")
+    if override is not None:
+        return override or None
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "mcp-pyrefly-autotype", "analysis")
+
 class PyreflyAnalyzer:
     """Wrapper for Pyrefly autotype functionality."""
     
-    def __init__(self):
+    def __init__(self, cache_dir: Optional[str] = None):
         self.project_context: Dict[str, Any] = {}
+        self.pyrefly_version = _PYREFLY_VERSION
+        # As with the environment variable, an empty cache_dir disables the disk cache
+        if cache_dir is None:
+            cache_dir = _default_cache_dir()
+        self._cache = AnalysisCache(directory=cache_dir or None)
+        # Caps concurrent Pyrefly subprocesses across all tool calls
+        self._sem = asyncio.Semaphore(min(32, (os.cpu_count() or 4) * 2))
     
-    async def analyze_file(self, file_path: str) -> Dict[str, Any]:
-        """Analyze a Python file using Pyrefly's analysis capabilities."""
-        try:
-            # Use Pyrefly to analyze the file
-            result = await self.run_pyrefly_command([
-                "uv", "run", "pyrefly", "autotype", file_path
-            ])
-            
-            if result["success"]:
-                # Parse Pyrefly's output for analysis information
-                analysis = self._parse_pyrefly_analysis(result["stdout"], file_path)
-                return analysis
+    async def analyze_file(self, file: str | FileRef) -> Dict[str, Any]:
+        """Analyze a Python file using Pyrefly's analysis capabilities.
+        
+        Accepts a path or a FileRef that was already loaded with _load.
+        """
+        file_path = file.path if isinstance(file, FileRef) else file
+        results = await self.analyze_files([file])
+        return results[file_path]
+    
+    async def analyze_files(self, files: Sequence[str | FileRef]) -> Dict[str, Dict[str, Any]]:
+        """Analyze several Python files concurrently.
+        
+        Files whose content was analyzed before are served from the cache;
+        the rest get one `pyrefly autotype` run each, all running at once
+        under the subprocess semaphore. Returns the per-file analysis keyed
+        by file path.
+        """
+        refs: Dict[str, Optional[FileRef]] = {}
+        for file in files:
+            if isinstance(file, FileRef):
+                refs[file.path] = file
+            elif file not in refs:
+                try:
+                    refs[file] = _load(file)
+                except OSError:
+                    # Let Pyrefly report on files we cannot read
+                    refs[file] = None
+        
+        results: Dict[str, Dict[str, Any]] = {}
+        pending: Dict[str, Optional[tuple[bytes, str]]] = {}
+        
+        for path, ref in refs.items():
+            key = (ref.digest, self.pyrefly_version) if ref is not None else None
+            cached = self._cache.get(key) if key is not None else None
+            if cached is not None:
+                results[path] = dict(cached, file_path=path)
             else:
-                return {
-                    "error": result.get("error", result.get("stderr", "Unknown error")),
-                    "file_path": file_path
-                }
-                
-        except Exception as e:
-            return {"error": str(e), "file_path": file_path}
-    
-    def _parse_pyrefly_analysis(self, output: str, file_path: str) -> Dict[str, Any]:
-        """Parse Pyrefly analysis output into structured data."""
-        functions_needing_types: List[str] = []
-        variables_needing_types: List[str] = []
-        
-        analysis: Dict[str, Any] = {
-            "file_path": file_path,
-            "functions_needing_types": functions_needing_types,
-            "variables_needing_types": variables_needing_types,
-            "suggested_types": {},
-            "total_functions": 0,
-            "total_variables": 0,
-            "pyrefly_output": output
-        }
+                pending[path] = key
+        
+        pending_paths = list(pending)
+        # One run per file: autotype rewrites files in place, so a combined
+        # run could neither be split per file reliably nor safely retried
+        analyses = await asyncio.gather(
+            *(self._run_autotype(path) for path in pending_paths),
+            return_exceptions=True
+        )
+        
+        for path, analysis in zip(pending_paths, analyses):
+            if isinstance(analysis, BaseException):
+                # One failing file must not abort the others
+                results[path] = {"error": str(analysis), "file_path": path}
+                continue
+            key = pending[path]
+            if key is not None and "error" not in analysis:
+                self._cache.put(key, analysis)
+            results[path] = analysis
+        
+        return {path: results[path] for path in refs}
+    
+    async def _run_autotype(self, file_path: str) -> Dict[str, Any]:
+        """Run `pyrefly autotype` on one file, parsing its output as it streams in."""
+        analysis = _empty_analysis(file_path, "")
+        
+        def on_line(line: str) -> None:
+            match = _ANALYSIS_RE.match(line)
+            if match is not None:
+                _record_match(analysis, match)
+        
+        result = await self._bounded_run(
+            [*_PYREFLY_CMD, "autotype", file_path],
+            on_line=on_line
+        )
         
-        # Parse the output to extract type information
-        lines = output.split('\n')
-        for line in lines:
-            line = line.strip()
-            if "function" in line.lower() and "type" in line.lower():
-                # Extract function information from Pyrefly output
-                # This will depend on Pyrefly's actual output format
-                functions_needing_types.append(line)
-            elif "variable" in line.lower() and "type" in line.lower():
-                variables_needing_types.append(line)
+        if not result["success"]:
+            return {
+                "error": result.get("error", result.get("stderr", "Unknown error")),
+                "file_path": file_path
+            }
         
+        analysis["pyrefly_output"] = result["stdout"]
         return analysis
     
     async def get_project_context(self, project_path: str) -> Dict[str, Any]:
@@ -79,26 +358,20 @@ class PyreflyAnalyzer:
         }
         
         try:
-            # Check if Pyrefly can analyze this project
-            pyrefly_check = await self.run_pyrefly_command([
-                "uv", "run", "pyrefly", "check", project_path
-            ])
+            # Check if Pyrefly can analyze this project, collecting Python files
+            # while it runs. Only `check` is run: autotype would rewrite the files.
+            pyrefly_check, python_files = await asyncio.gather(
+                self._bounded_run([*_PYREFLY_CMD, "check", project_path]),
+                asyncio.to_thread(lambda: list(_iter_python_files(project_path)))
+            )
             
             context["pyrefly_compatible"] = pyrefly_check["success"]
-            
-            # Collect Python files
-            for root, dirs, files in os.walk(project_path):
-                dirs[:] = [d for d in dirs if not d.startswith('.') and d not in ['__pycache__', 'node_modules']]
-                
-                for file in files:
-                    if file.endswith('.py'):
-                        file_path = os.path.join(root, file)
-                        context["python_files"].append(file_path)
+            context["python_files"] = python_files
             
             if pyrefly_check["success"]:
                 context["analysis_summary"] = {
                     "output": pyrefly_check["stdout"],
-                    "total_files": len(context["python_files"])
+                    "total_files": len(python_files)
                 }
         
         except Exception as e:
@@ -106,23 +379,38 @@ class PyreflyAnalyzer:
         
         return context
     
-    async def run_pyrefly_command(self, cmd: List[str], timeout: int = 60) -> Dict[str, Any]:
-        """Run a Pyrefly command and return the results."""
+    async def _bounded_run(
+        self,
+        cmd: List[str],
+        timeout: float = 60,
+        on_line: Optional[Callable[[str], None]] = None
+    ) -> Dict[str, Any]:
+        """Run a Pyrefly command, limiting how many run at once."""
+        async with self._sem:
+            return await self.run_pyrefly_command(cmd, timeout, on_line=on_line)
+    
+    async def run_pyrefly_command(
+        self,
+        cmd: List[str],
+        timeout: float = 60,
+        on_line: Optional[Callable[[str], None]] = None
+    ) -> Dict[str, Any]:
+        """Run a Pyrefly command and return the results.
+        
+        With on_line, stdout is streamed to it and the returned stdout holds
+        only the tail of the output; the result is then marked as streamed.
+        """
         try:
-            result = subprocess.run(
-                cmd, 
-                capture_output=True, 
-                text=True, 
-                timeout=timeout
-            )
+            returncode, stdout, stderr = await _run_subprocess(cmd, timeout, on_line)
             
             return {
-                "success": result.returncode == 0,
-                "stdout": result.stdout,
-                "stderr": result.stderr,
-                "returncode": result.returncode
+                "success": returncode == 0,
+                "stdout": stdout,
+                "stderr": stderr,
+                "returncode": returncode,
+                "streamed": on_line is not None
             }
-        except subprocess.TimeoutExpired:
+        except asyncio.TimeoutError:
             return {
                 "success": False,
                 "error": f"Pyrefly execution timed out after {timeout}s"
@@ -133,23 +421,133 @@ class PyreflyAnalyzer:
                 "error": str(e)
             }
 
+def _empty_analysis(file_path: str, output: str) -> Dict[str, Any]:
+    """Build an analysis result with no findings yet."""
+    return {
+        "file_path": file_path,
+        "functions_needing_types": [],
+        "variables_needing_types": [],
+        "suggested_types": {},
+        "total_functions": 0,
+        "total_variables": 0,
+        "pyrefly_output": output
+    }
+
+def _record_match(analysis: Dict[str, Any], match: re.Match[str]) -> None:
+    """Add one _ANALYSIS_RE match to an analysis result."""
+    # This will depend on Pyrefly's actual output format
+    line = match.group(0).strip()
+    # A line mentioning both kinds counts as a function, as it always has
+    if "function" in line.lower():
+        analysis["functions_needing_types"].append(line)
+    else:
+        analysis["variables_needing_types"].append(line)
+
+def _iter_python_files(root: str) -> Iterator[str]:
+    """Yield the .py files under root, skipping hidden and tooling directories."""
+    try:
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if not entry.name.startswith('.') and entry.name not in _SKIP_DIRS:
+                        yield from _iter_python_files(entry.path)
+                elif entry.name.endswith('.py'):
+                    yield entry.path
+    except OSError:
+        # Unreadable directories are skipped, as os.walk does
+        return
+
+async def _run_subprocess(
+    cmd: List[str],
+    timeout: float,
+    on_line: Optional[Callable[[str], None]] = None
+) -> tuple[Optional[int], str, str]:
+    """Run a command without blocking the event loop.
+    
+    Returns (returncode, stdout, stderr). When on_line is given, stdout is
+    passed to it line by line as it arrives and only the last
+    STREAM_TAIL_CHARS characters are returned. The process is killed and
+    asyncio.TimeoutError re-raised if it does not finish within timeout;
+    it is likewise killed if the call fails or is cancelled.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        if on_line is None:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+            return proc.returncode, stdout.decode(errors="replace"), stderr.decode(errors="replace")
+        
+        tail, stderr = await asyncio.wait_for(_stream_output(proc, on_line), timeout=timeout)
+        return proc.returncode, tail, stderr.decode(errors="replace")
+    except BaseException:
+        # Timeouts, errors and cancelled requests must not leave Pyrefly running
+        if proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+        raise
+
+async def _stream_output(
+    proc: asyncio.subprocess.Process,
+    on_line: Callable[[str], None]
+) -> tuple[str, bytes]:
+    """Feed a process's stdout to on_line, keeping only a bounded tail of it."""
+    assert proc.stdout is not None and proc.stderr is not None
+    tail: deque[str] = deque()
+    tail_size = 0
+    truncated = False
+    
+    def feed(raw: bytes) -> None:
+        nonlocal tail_size, truncated
+        line = raw.decode(errors="replace")
+        on_line(line)
+        tail.append(line)
+        tail_size += len(line)
+        while tail_size > STREAM_TAIL_CHARS and len(tail) > 1:
+            tail_size -= len(tail.popleft())
+            truncated = True
+    
+    async def pump() -> None:
+        # Split lines ourselves: StreamReader.readline rejects lines over its limit
+        buf = bytearray()
+        while chunk := await proc.stdout.read(STREAM_CHUNK_BYTES):
+            scan = len(buf)
+            buf += chunk
+            start = 0
+            while (end := buf.find(b"\n", scan)) != -1:
+                feed(bytes(buf[start:end + 1]))
+                start = scan = end + 1
+            del buf[:start]
+        if buf:
+            feed(bytes(buf))
+    
+    # Drain stderr concurrently so a chatty process cannot block on a full pipe
+    _, stderr = await asyncio.gather(pump(), proc.stderr.read())
+    await proc.wait()
+    
+    output = "".join(tail)
+    return ("...\n" + output if truncated else output), stderr
+
 async def run_pyrefly_check(file_path: str) -> Dict[str, Any]:
     """Run pyrefly type checking on a file."""
     try:
-        result = subprocess.run(
-            ["uv", "run", "pyrefly", "check", file_path],
-            capture_output=True,
-            text=True,
+        returncode, stdout, stderr = await _run_subprocess(
+            [*_PYREFLY_CMD, "check", file_path],
             timeout=30
         )
         
         return {
-            "success": result.returncode == 0,
-            "output": result.stdout,
-            "errors": result.stderr,
-            "returncode": result.returncode
+            "success": returncode == 0,
+            "output": stdout,
+            "errors": stderr,
+            "returncode": returncode
         }
-    except subprocess.TimeoutExpired:
+    except asyncio.TimeoutError:
         return {
             "success": False,
             "error": "Pyrefly check execution timed out"
@@ -160,22 +558,228 @@ async def run_pyrefly_check(file_path: str) -> Dict[str, Any]:
             "error": str(e)
         }
 
+class AnalysisBatcher:
+    """Coalesce bursts of analyze requests into shared analyze_files calls."""
+    
+    def __init__(
+        self,
+        analyzer: PyreflyAnalyzer,
+        batch_size: int = BATCH_SIZE,
+        debounce: float = BATCH_DEBOUNCE_SECONDS
+    ):
+        self.analyzer = analyzer
+        self.batch_size = max(1, batch_size)
+        self.debounce = debounce
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue[tuple[str | FileRef, asyncio.Future[Dict[str, Any]]]]] = None
+        self._tasks: set[asyncio.Task[None]] = set()
+    
+    async def analyze(self, file: str | FileRef) -> Dict[str, Any]:
+        """Queue a file for analysis and wait for its batch to finish."""
+        loop = asyncio.get_running_loop()
+        if self._queue is None or self._loop is not loop:
+            # Queues and tasks are bound to the loop that first uses them
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._tasks = set()
+            self._spawn(self._collect(self._queue))
+        
+        future: asyncio.Future[Dict[str, Any]] = loop.create_future()
+        await self._queue.put((file, future))
+        return await future
+    
+    async def aclose(self) -> None:
+        """Cancel the collector and any in-flight batches."""
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._queue = None
+        self._loop = None
+    
+    def _spawn(self, coro: Any) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _collect(self, queue: asyncio.Queue[tuple[str | FileRef, asyncio.Future[Dict[str, Any]]]]) -> None:
+        while True:
+            batch = [await queue.get()]
+            await asyncio.sleep(self.debounce)
+            while len(batch) < self.batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+            # Dispatch without awaiting so the next batch can form meanwhile
+            self._spawn(self._dispatch(batch))
+    
+    async def _dispatch(self, batch: List[tuple[str | FileRef, asyncio.Future[Dict[str, Any]]]]) -> None:
+        try:
+            results = await self.analyzer.analyze_files([file for file, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        for file, future in batch:
+            if not future.done():
+                future.set_result(results[file.path if isinstance(file, FileRef) else file])
+
 # Initialize the Pyrefly analyzer
 pyrefly_analyzer = PyreflyAnalyzer()
+analysis_batcher = AnalysisBatcher(pyrefly_analyzer)
+
+# Tool, prompt and resource listings never change, so they are built once
+_ANALYZE_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "file_path": {
+            "type": "string",
+            "description": "Path to the Python file to analyze"
+        },
+        "detailed": {
+            "type": "boolean", 
+            "description": "Include detailed analysis information",
+            "default": False
+        }
+    },
+    "required": ["file_path"],
+}
+
+_ADD_TYPES_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "file_path": {
+            "type": "string",
+            "description": "Path to the Python file to add types to"
+        },
+        "backup": {
+            "type": "boolean",
+            "description": "Create a backup of the original file",
+            "default": True
+        },
+        "aggressive": {
+            "type": "boolean",
+            "description": "Use aggressive type inference",
+            "default": False
+        },
+        "safe_mode": {
+            "type": "boolean",
+            "description": "Use safe mode for type inference",
+            "default": True
+        }
+    },
+    "required": ["file_path"],
+}
+
+_TYPE_CHECK_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "file_path": {
+            "type": "string",
+            "description": "Path to the Python file to type check"
+        }
+    },
+    "required": ["file_path"],
+}
+
+_PROJECT_CONTEXT_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "project_path": {
+            "type": "string",
+            "description": "Path to the project directory"
+        }
+    },
+    "required": ["project_path"],
+}
+
+_TOOLS: list[types.Tool] = [
+    types.Tool(
+        name="analyze_python_file",
+        description="Analyze a Python file for missing type annotations",
+        inputSchema=_ANALYZE_SCHEMA,
+    ),
+    types.Tool(
+        name="add_types_to_file",
+        description="Add type annotations to a Python file using Pyrefly",
+        inputSchema=_ADD_TYPES_SCHEMA,
+    ),
+    types.Tool(
+        name="type_check_file",
+        description="Run type checking on a Python file using Pyrefly",
+        inputSchema=_TYPE_CHECK_SCHEMA,
+    ),
+    types.Tool(
+        name="get_project_context",
+        description="Get project-wide type information for better type inference",
+        inputSchema=_PROJECT_CONTEXT_SCHEMA,
+    ),
+]
+
+_PROMPTS: list[types.Prompt] = [
+    types.Prompt(
+        name="analyze_typing_needs",
+        description="Analyze a Python file or project to determine typing needs",
+        arguments=[
+            types.PromptArgument(
+                name="file_path",
+                description="Path to the Python file to analyze",
+                required=True,
+            ),
+            types.PromptArgument(
+                name="include_suggestions",
+                description="Include type suggestions in the analysis",
+                required=False,
+            )
+        ],
+    ),
+    types.Prompt(
+        name="type_improvement_plan",
+        description="Create a plan for improving type coverage in a project",
+        arguments=[
+            types.PromptArgument(
+                name="project_path",
+                description="Path to the project directory",
+                required=True,
+            ),
+            types.PromptArgument(
+                name="priority",
+                description="Priority level (high/medium/low)",
+                required=False,
+            )
+        ],
+    )
+]
+
+_STATUS_URI: Final = AnyUrl("pyrefly://analysis/status")
+
+# Static part of the status resource; cache counters are added per read
+_STATUS: Final[Dict[str, Any]] = {
+    "status": "active",
+    "capabilities": [
+        "Python file analysis",
+        "Type inference",
+        "Type checking",
+        "Project context analysis"
+    ],
+    "supported_tools": [tool.name for tool in _TOOLS]
+}
+
+_RESOURCES: list[types.Resource] = [
+    types.Resource(
+        uri=_STATUS_URI,
+        name="Pyrefly Analysis Status",
+        description="Current status and capabilities of the Pyrefly type analyzer",
+        mimeType="application/json",
+    )
+]
 
 @server.list_resources()
 async def handle_list_resources() -> list[types.Resource]:
     """
     List available resources for Python type analysis.
     """
-    return [
-        types.Resource(
-            uri=AnyUrl("pyrefly://analysis/status"),
-            name="Pyrefly Analysis Status",
-            description="Current status and capabilities of the Pyrefly type analyzer",
-            mimeType="application/json",
-        )
-    ]
+    return _RESOURCES
 
 @server.read_resource()
 async def handle_read_resource(uri: AnyUrl) -> str:
@@ -185,22 +789,14 @@ async def handle_read_resource(uri: AnyUrl) -> str:
     if uri.scheme != "pyrefly":
         raise ValueError(f"Unsupported URI scheme: {uri.scheme}")
     
-    if str(uri) == "pyrefly://analysis/status":
-        return """{
-    "status": "active",
-    "capabilities": [
-        "Python file analysis",
-        "Type inference",
-        "Type checking",
-        "Project context analysis"
-    ],
-    "supported_tools": [
-        "analyze_python_file",
-        "add_types_to_file", 
-        "type_check_file",
-        "get_project_context"
-    ]
-}"""
+    if uri == _STATUS_URI:
+        cache = pyrefly_analyzer._cache
+        return json.dumps({
+            **_STATUS,
+            "pyrefly_version": pyrefly_analyzer.pyrefly_version,
+            "cache_hits": cache.hits,
+            "cache_misses": cache.misses
+        }, separators=(",", ":"))
     
     raise ValueError(f"Unknown resource: {uri}")
 
@@ -209,40 +805,7 @@ async def handle_list_prompts() -> list[types.Prompt]:
     """
     List available prompts for Python type analysis.
     """
-    return [
-        types.Prompt(
-            name="analyze_typing_needs",
-            description="Analyze a Python file or project to determine typing needs",
-            arguments=[
-                types.PromptArgument(
-                    name="file_path",
-                    description="Path to the Python file to analyze",
-                    required=True,
-                ),
-                types.PromptArgument(
-                    name="include_suggestions",
-                    description="Include type suggestions in the analysis",
-                    required=False,
-                )
-            ],
-        ),
-        types.Prompt(
-            name="type_improvement_plan",
-            description="Create a plan for improving type coverage in a project",
-            arguments=[
-                types.PromptArgument(
-                    name="project_path",
-                    description="Path to the project directory",
-                    required=True,
-                ),
-                types.PromptArgument(
-                    name="priority",
-                    description="Priority level (high/medium/low)",
-                    required=False,
-                )
-            ],
-        )
-    ]
+    return _PROMPTS
 
 @server.get_prompt()
 async def handle_get_prompt(
@@ -333,84 +896,41 @@ async def handle_list_tools() -> list[types.Tool]:
     """
     List available tools for Python type analysis and modification.
     """
-    return [
-        types.Tool(
-            name="analyze_python_file",
-            description="Analyze a Python file for missing type annotations",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "file_path": {
-                        "type": "string",
-                        "description": "Path to the Python file to analyze"
-                    },
-                    "detailed": {
-                        "type": "boolean", 
-                        "description": "Include detailed analysis information",
-                        "default": False
-                    }
-                },
-                "required": ["file_path"],
-            },
-        ),
-        types.Tool(
-            name="add_types_to_file",
-            description="Add type annotations to a Python file using Pyrefly",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "file_path": {
-                        "type": "string",
-                        "description": "Path to the Python file to add types to"
-                    },
-                    "backup": {
-                        "type": "boolean",
-                        "description": "Create a backup of the original file",
-                        "default": True
-                    },
-                    "aggressive": {
-                        "type": "boolean",
-                        "description": "Use aggressive type inference",
-                        "default": False
-                    },
-                    "safe_mode": {
-                        "type": "boolean",
-                        "description": "Use safe mode for type inference",
-                        "default": True
-                    }
-                },
-                "required": ["file_path"],
-            },
-        ),
-        types.Tool(
-            name="type_check_file",
-            description="Run type checking on a Python file using Pyrefly",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "file_path": {
-                        "type": "string",
-                        "description": "Path to the Python file to type check"
-                    }
-                },
-                "required": ["file_path"],
-            },
-        ),
-        types.Tool(
-            name="get_project_context",
-            description="Get project-wide type information for better type inference",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "project_path": {
-                        "type": "string",
-                        "description": "Path to the project directory"
-                    }
-                },
-                "required": ["project_path"],
-            },
-        ),
-    ]
+    return _TOOLS
+
+def _cheap_backup(src: str, dst: str) -> str:
+    """Copy src to dst, as a copy-on-write reflink where the filesystem allows.
+    
+    Returns "reflink" or "copy". Hardlinks are deliberately not used: Pyrefly
+    may rewrite the original in place, which would change the backup too.
+    """
+    if fcntl is not None:
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+            shutil.copystat(src, dst)
+            return "reflink"
+        except OSError:
+            # Not supported here (e.g. ext4, tmpfs, or across filesystems)
+            pass
+    
+    shutil.copy2(src, dst)
+    return "copy"
+
+def _bullet_list(items: List[str]) -> str:
+    """Format items as an indented bullet list for tool output."""
+    if not items:
+        return "  (none)"
+    return "  - " + "\n  - ".join(items)
+
+def _load_tool_file(file_path: str) -> FileRef:
+    """Load a file named in tool arguments, reporting problems as ValueError."""
+    try:
+        return _load(file_path)
+    except FileNotFoundError:
+        raise ValueError(f"File not found: {file_path}")
+    except OSError as e:
+        raise ValueError(f"Cannot read file {file_path}: {e}")
 
 @server.call_tool()
 async def handle_call_tool(
@@ -429,29 +949,34 @@ async def handle_call_tool(
         if not file_path:
             raise ValueError("Missing file_path argument")
         
-        if not os.path.exists(file_path):
-            raise ValueError(f"File not found: {file_path}")
-        
-        analysis = await pyrefly_analyzer.analyze_file(file_path)
+        ref = _load_tool_file(file_path)
+        analysis = await analysis_batcher.analyze(ref)
+        funcs = analysis.get("functions_needing_types", [])
+        vars_ = analysis.get("variables_needing_types", [])
         
         if detailed:
+            suggested = analysis.get("suggested_types", {})
+            pyout = analysis.get("pyrefly_output", "No output available")
+            funcs_txt = _bullet_list(funcs)
+            vars_txt = _bullet_list(vars_)
+            suggested_txt = _bullet_list([f"{name}: {type_hint}" for name, type_hint in suggested.items()])
             result_text = f"""Detailed Pyrefly Analysis for {file_path}:
 
-Functions needing types ({len(analysis.get('functions_needing_types', []))}):
-{chr(10).join(f"  - {func}" for func in analysis.get('functions_needing_types', []))}
+Functions needing types ({len(funcs)}):
+{funcs_txt}
 
-Variables needing types ({len(analysis.get('variables_needing_types', []))}):
-{chr(10).join(f"  - {var}" for var in analysis.get('variables_needing_types', []))}
+Variables needing types ({len(vars_)}):
+{vars_txt}
 
 Suggested types:
-{chr(10).join(f"  - {name}: {type_hint}" for name, type_hint in analysis.get('suggested_types', {}).items())}
+{suggested_txt}
 
 Pyrefly Output:
-{analysis.get('pyrefly_output', 'No output available')}"""
+{pyout}"""
         else:
             result_text = f"""Pyrefly Analysis for {file_path}:
-Functions needing types: {len(analysis.get('functions_needing_types', []))}
-Variables needing types: {len(analysis.get('variables_needing_types', []))}"""
+Functions needing types: {len(funcs)}
+Variables needing types: {len(vars_)}"""
         
         return [types.TextContent(type="text", text=result_text)]
     
@@ -471,14 +996,13 @@ Variables needing types: {len(analysis.get('variables_needing_types', []))}"""
         if backup:
             backup_path = f"{file_path}.backup"
             try:
-                import shutil
-                shutil.copy2(file_path, backup_path)
+                _cheap_backup(file_path, backup_path)
             except Exception as e:
                 return [types.TextContent(type="text", text=f"Failed to create backup: {e}")]
         
         # Run Pyrefly autotype directly via analyzer
         result = await pyrefly_analyzer.run_pyrefly_command([
-            "uv", "run", "pyrefly", "autotype", file_path
+            *_PYREFLY_CMD, "autotype", file_path
         ])
         
         if result["success"]:
@@ -487,9 +1011,10 @@ Variables needing types: {len(analysis.get('variables_needing_types', []))}"""
                 text=f"Successfully added types to {file_path}\n\nOutput:\n{result['stdout']}"
             )]
         else:
+            err = result.get("error") or result.get("stderr") or "Unknown error"
             return [types.TextContent(
                 type="text", 
-                text=f"Failed to add types to {file_path}\n\nError:\n{result.get('error', result.get('stderr', 'Unknown error'))}"
+                text=f"Failed to add types to {file_path}\n\nError:\n{err}"
             )]
     
     elif name == "type_check_file":
@@ -502,16 +1027,19 @@ Variables needing types: {len(analysis.get('variables_needing_types', []))}"""
             raise ValueError(f"File not found: {file_path}")
         
         result = await run_pyrefly_check(file_path)
+        output = result.get("output", "")
         
         if result["success"]:
             return [types.TextContent(
                 type="text", 
-                text=f"Type checking passed for {file_path}\n\nOutput:\n{result['output']}"
+                text=f"Type checking passed for {file_path}\n\nOutput:\n{output}"
             )]
         else:
+            # Timeouts and launch failures report "error" instead of output/errors
+            errors = result.get("errors") or result.get("error", "")
             return [types.TextContent(
                 type="text", 
-                text=f"Type checking found issues in {file_path}\n\nErrors:\n{result['output']}\n{result.get('errors', '')}"
+                text=f"Type checking found issues in {file_path}\n\nErrors:\n{output}\n{errors}"
             )]
     
     elif name == "get_project_context":
@@ -524,18 +1052,20 @@ Variables needing types: {len(analysis.get('variables_needing_types', []))}"""
             raise ValueError(f"Project path not found: {project_path}")
         
         context = await pyrefly_analyzer.get_project_context(project_path)
+        python_files = context.get("python_files", [])
+        summary_output = context.get("analysis_summary", {}).get("output", "No analysis available")
         
         result_text = f"""Project Context for {project_path}:
 
-Python files found: {len(context.get('python_files', []))}
+Python files found: {len(python_files)}
 Pyrefly compatible: {context.get('pyrefly_compatible', False)}
 
 Analysis summary:
-{context.get('analysis_summary', {}).get('output', 'No analysis available')}
+{summary_output}
 
 Files:
-{chr(10).join(f"  - {file}" for file in context.get('python_files', [])[:20])}
-{"  ... and more" if len(context.get('python_files', [])) > 20 else ""}"""
+{_bullet_list(python_files[:20])}
+{"  ... and more" if len(python_files) > 20 else ""}"""
         
         return [types.TextContent(type="text", text=result_text)]
     
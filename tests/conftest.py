@@ -0,0 +1,23 @@
+"""Shared fixtures for the Pyrefly autotype MCP server tests."""
+
+import pytest
+
+try:
+    import uvloop
+except ImportError:  # Not available on Windows
+    uvloop = None
+
+# Demo scripts that drive the real `uv run pyrefly`; run them directly instead
+collect_ignore = ["test_demo.py", "test_direct.py"]
+
+
+if uvloop is not None:
+    def pytest_asyncio_loop_factories(config, item):
+        """Run the suite on uvloop where it is installed."""
+        return {"uvloop": uvloop.new_event_loop}
+
+
+@pytest.fixture(autouse=True)
+def isolated_analysis_cache(tmp_path, monkeypatch):
+    """Keep persisted analysis results out of the user's cache directory."""
+    monkeypatch.setenv("PYREFLY_AUTOTYPE_CACHE_DIR", str(tmp_path / "analysis-cache"))
@@ -1,35 +1,55 @@
+import functools
 import math
+import operator
 import random
-import datetime
 import json
 import os
+import time
 from collections import defaultdict
 
 # Global constants
 PI = math.pi
 DATA_DIR = "data"
+PRICE_OR_ZERO = operator.methodcaller("get", "price", 0)
+
+DISCOUNT_RULES = {
+    "percent": lambda total, value: total - total * (value / 100),
+    "fixed": lambda total, value: total - value,
+}
+
+
+def order_total(items, discounts):
+    total = 0
+    for item in items:
+        total += item["price"] * item.get("quantity", 1)
+    for d in discounts:
+        rule = DISCOUNT_RULES.get(d["type"])
+        if rule is not None:
+            total = rule(total, d["value"])
+    return max(total, 0)
+
 
 # A simple class with multiple responsibilities
 class OrderProcessor:
+    __slots__ = ("order_id", "items", "discounts", "status",
+                 "tracking_number", "shipped_at_ns", "_total")
+
     def __init__(self, order_id, items, discounts=None):
         self.order_id = order_id
         self.items = items
         self.discounts = discounts or []
         self.status = "pending"
+        self._total = None
 
     def calculate_total(self):
-        total = sum(item["price"] * item.get("quantity", 1) for item in self.items)
-        for d in self.discounts:
-            if d["type"] == "percent":
-                total -= total * (d["value"] / 100)
-            elif d["type"] == "fixed":
-                total -= d["value"]
-        return max(total, 0)
+        if self._total is None:
+            self._total = order_total(self.items, self.discounts)
+        return self._total
 
     def mark_shipped(self, tracking_number):
         self.status = "shipped"
         self.tracking_number = tracking_number
-        self.shipped_at = datetime.datetime.now()
+        self.shipped_at_ns = time.time_ns()
 
     def serialize(self):
         return {
@@ -44,14 +64,23 @@ class OrderProcessor:
 def fibonacci(n):
     if n <= 1:
         return n
-    return fibonacci(n - 1) + fibonacci(n - 2)
+    a, b = 0, 1
+    for _ in range(n):
+        a, b = b, a + b
+    return a
+
+@functools.lru_cache(maxsize=128)
+def _load_json(path, mtime_ns):
+    with open(path, "rb") as f:
+        return json.loads(f.read())
 
 def load_json_file(file_name):
+    # Cached per mtime, so callers share the parsed object and must not mutate it
     path = os.path.join(DATA_DIR, file_name)
-    if not os.path.exists(path):
+    try:
+        return _load_json(path, os.stat(path).st_mtime_ns)
+    except FileNotFoundError:
         return {}
-    with open(path, "r") as f:
-        return json.load(f)
 
 def group_by_first_letter(words):
     grouped = defaultdict(list)
@@ -61,44 +90,46 @@ def group_by_first_letter(words):
     return dict(grouped)
 
 def random_points_in_circle(radius, count):
+    rand, sqrt, cos, sin = random.random, math.sqrt, math.cos, math.sin
+    two_pi = 2 * PI
     points = []
     for _ in range(count):
-        angle = random.uniform(0, 2 * PI)
-        r = radius * math.sqrt(random.random())
-        x = r * math.cos(angle)
-        y = r * math.sin(angle)
-        points.append((x, y))
+        angle = two_pi * rand()
+        r = radius * sqrt(rand())
+        points.append((r * cos(angle), r * sin(angle)))
     return points
 
 def get_most_expensive_item(items):
     if not items:
         return None
-    return max(items, key=lambda x: x.get("price", 0))
+    return max(items, key=PRICE_OR_ZERO)
 
 
 # More complex function
 def process_orders(orders):
     processed = []
+    append = processed.append
     for o in orders:
-        op = OrderProcessor(o["id"], o["items"], o.get("discounts"))
-        total = op.calculate_total()
-        if total > 100:
-            op.mark_shipped("TRACK123")
-        processed.append(op.serialize())
+        items = o["items"]
+        total = order_total(items, o.get("discounts") or [])
+        append({
+            "order_id": o["id"],
+            "status": "shipped" if total > 100 else "pending",
+            "items": items,
+            "total": total,
+        })
     return processed
 
 
 # Nested data manipulation
 def merge_user_data(user_list, activity_list):
-    merged = {}
-    for user in user_list:
-        uid = user["id"]
-        merged[uid] = {"name": user["name"], "activities": []}
+    activities_by_user = defaultdict(list)
     for activity in activity_list:
-        uid = activity["user_id"]
-        if uid in merged:
-            merged[uid]["activities"].append(activity)
-    return merged
+        activities_by_user[activity["user_id"]].append(activity)
+    return {
+        user["id"]: {"name": user["name"], "activities": activities_by_user.get(user["id"], [])}
+        for user in user_list
+    }
 
 
 # Simple CLI
@@ -2,79 +2,298 @@
 
 import asyncio
 import json
-import subprocess
 import tempfile
 import os
+import time
+from dataclasses import dataclass
 from pathlib import Path
-from unittest.mock import AsyncMock, MagicMock, patch
+from unittest.mock import patch
+from uuid import uuid4
+
+import pytest
 
 from mcp_pyrefly_autotype.server import (
+    CACHE_MAX_AGE_SECONDS,
+    AnalysisBatcher,
     PyreflyAnalyzer,
+    _CACHE_MARKER,
+    _batch_size_from_env,
+    _cheap_backup,
     run_pyrefly_check,
     server
 )
 
 
+def make_stream(data):
+    """Build an already-finished StreamReader holding data."""
+    stream = asyncio.StreamReader()
+    stream.feed_data(data.encode())
+    stream.feed_eof()
+    return stream
+
+
+@dataclass(slots=True)
+class FakeProc:
+    """Stand-in for the Process returned by asyncio.create_subprocess_exec."""
+    returncode: int | None
+    stdout: asyncio.StreamReader
+    stderr: asyncio.StreamReader
+    output: tuple[bytes, bytes]
+    hangs: bool = False
+    kills: int = 0
+    
+    async def communicate(self):
+        if self.hangs:
+            await asyncio.sleep(10)
+        return self.output
+    
+    async def wait(self):
+        return self.returncode
+    
+    def kill(self):
+        self.kills += 1
+        self.returncode = -9
+
+
+def make_process(returncode=0, stdout="", stderr="", hangs=False):
+    """Build a finished FakeProc, or one whose communicate() never returns."""
+    # A process that is still running has no returncode yet
+    return FakeProc(
+        None if hangs else returncode, make_stream(stdout), make_stream(stderr),
+        (stdout.encode(), stderr.encode()), hangs
+    )
+
+
+def pyrefly_result(stdout="", on_line=None, **overrides):
+    """Build a run_pyrefly_command result, streaming stdout to on_line as the real one does."""
+    if on_line is not None:
+        for line in stdout.splitlines(keepends=True):
+            on_line(line)
+    return {
+        "success": True, "stdout": stdout, "stderr": "", "returncode": 0,
+        "streamed": on_line is not None, **overrides
+    }
+
+
+def fake_run(stdout="", **overrides):
+    """Build a run_pyrefly_command stand-in that always produces the same output."""
+    async def run(cmd, timeout=60, on_line=None):
+        return pyrefly_result(stdout, on_line, **overrides)
+    return run
+
+
+@pytest.fixture(scope="module")
+def _shared_analyzer(tmp_path_factory):
+    """One analyzer with Pyrefly patched out, shared by the whole module."""
+    analyzer = PyreflyAnalyzer(cache_dir=str(tmp_path_factory.mktemp("analysis-cache")))
+    with patch.object(analyzer, 'run_pyrefly_command') as mock_cmd:
+        yield analyzer, mock_cmd
+
+
+@pytest.fixture
+def analyzer_with_mock(_shared_analyzer):
+    """Yield the shared (analyzer, mock_cmd) pair and reset the mock afterwards."""
+    analyzer, mock_cmd = _shared_analyzer
+    yield analyzer, mock_cmd
+    mock_cmd.reset_mock(return_value=True, side_effect=True)
+
+
 class TestPyreflyAnalyzer:
     """Test the PyreflyAnalyzer class."""
     
-    async def test_analyze_file_success(self):
+    async def test_analyze_file_success(self, analyzer_with_mock):
         """Test successful file analysis."""
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False) as f:
-            f.write("""
-def hello(name):
-    return f"Hello {name}"
-
-x = 42
-""")
-            f.flush()
+        # Pyrefly is mocked, so the file never has to exist on disk
+        file_path = f"/virtual/test_{uuid4()}.py"
+        
+        # Mock the Pyrefly command
+        analyzer, mock_cmd = analyzer_with_mock
+        mock_cmd.side_effect = fake_run("Function hello needs type annotations\nVariable x inferred as int")
+        
+        result = await analyzer.analyze_file(file_path)
+        
+        assert result["file_path"] == file_path
+        assert result["functions_needing_types"] == ["Function hello needs type annotations"]
+        assert "variables_needing_types" in result
+        assert "pyrefly_output" in result
+    
+    async def test_analyze_file_error(self, analyzer_with_mock):
+        """Test file analysis with error."""
+        analyzer, mock_cmd = analyzer_with_mock
+        mock_cmd.side_effect = fake_run(success=False, stderr="File not found", error="File not found")
+
+        result = await analyzer.analyze_file("nonexistent.py")
+
+        assert "error" in result
+        assert result["file_path"] == "nonexistent.py"
+    
+    async def test_analyze_files_runs_each_file_once(self, analyzer_with_mock):
+        """Test that each file gets exactly one Pyrefly run of its own."""
+        analyzer, mock_cmd = analyzer_with_mock
+        
+        async def run(cmd, timeout=60, on_line=None):
+            name = os.path.splitext(cmd[-1])[0]
+            return pyrefly_result(f"Function {name} needs type annotations", on_line)
+        
+        mock_cmd.side_effect = run
+        
+        results = await analyzer.analyze_files(["a.py", "b.py"])
+        
+        assert sorted(call.args[0][-1] for call in mock_cmd.call_args_list) == ["a.py", "b.py"]
+        assert results["a.py"]["functions_needing_types"] == ["Function a needs type annotations"]
+        assert results["b.py"]["functions_needing_types"] == ["Function b needs type annotations"]
+    
+    async def test_failing_file_does_not_fail_others(self, analyzer_with_mock):
+        """Test that one failing file does not fail the files analyzed with it."""
+        analyzer, mock_cmd = analyzer_with_mock
+        
+        async def run(cmd, timeout=60, on_line=None):
+            if cmd[-1] == "bad.py":
+                return pyrefly_result(success=False, error="bad.py: syntax error")
+            return pyrefly_result("Function ok needs type annotations", on_line)
+        
+        mock_cmd.side_effect = run
+        
+        results = await analyzer.analyze_files(["good.py", "bad.py"])
+        
+        assert mock_cmd.call_count == 2
+        assert results["good.py"]["functions_needing_types"] == ["Function ok needs type annotations"]
+        assert results["bad.py"]["error"] == "bad.py: syntax error"
+    
+    async def test_analyze_file_cached(self):
+        """Test that unchanged files are served from the analysis cache."""
+        with tempfile.TemporaryDirectory() as tmp:
+            file_path = os.path.join(tmp, "cached.py")
+            with open(file_path, "w") as f:
+                f.write("def hello(name):\n    return name\n")
             
-            # Mock the Pyrefly command
             analyzer = PyreflyAnalyzer()
             with patch.object(analyzer, 'run_pyrefly_command') as mock_cmd:
-                mock_cmd.return_value = {
-                    "success": True,
-                    "stdout": "Function hello needs type annotations\nVariable x inferred as int",
-                    "stderr": "",
-                    "returncode": 0
-                }
+                mock_cmd.side_effect = fake_run("Function hello needs type annotations")
                 
-                result = await analyzer.analyze_file(f.name)
+                first = await analyzer.analyze_file(file_path)
+                second = await analyzer.analyze_file(file_path)
                 
-                assert result["file_path"] == f.name
-                assert "functions_needing_types" in result
-                assert "variables_needing_types" in result
-                assert "pyrefly_output" in result
-        
-        # Clean up
-        os.unlink(f.name)
+                mock_cmd.assert_called_once()
+                assert first == second
+                assert analyzer._cache.hits == 1
+                assert analyzer._cache.misses == 1
     
-    async def test_analyze_file_error(self):
-        """Test file analysis with error."""
-        analyzer = PyreflyAnalyzer()
+    async def test_analysis_cache_persists(self):
+        """Test that cached results survive a new analyzer instance."""
+        with tempfile.TemporaryDirectory() as tmp:
+            file_path = os.path.join(tmp, "persisted.py")
+            with open(file_path, "w") as f:
+                f.write("x = 1\n")
+            cache_dir = os.path.join(tmp, "cache")
+            
+            for expected_calls in (1, 0):
+                analyzer = PyreflyAnalyzer(cache_dir=cache_dir)
+                analyzer.pyrefly_version = "pyrefly 0.0.0-test"
+                with patch.object(analyzer, 'run_pyrefly_command') as mock_cmd:
+                    mock_cmd.side_effect = fake_run("Variable x needs a type")
+                    
+                    result = await analyzer.analyze_file(file_path)
+                    
+                    assert mock_cmd.call_count == expected_calls
+                    assert result["variables_needing_types"] == ["Variable x needs a type"]
+    
+    async def test_analysis_cache_prunes_other_versions(self, tmp_path):
+        """Test that the disk cache only drops its own long-unused version directories."""
+        file_path = tmp_path / "module.py"
+        file_path.write_text("x = 1\n")
+        cache_dir = tmp_path / "cache"
+        stale = time.time() - CACHE_MAX_AGE_SECONDS - 60
+        for name, marked, last_used in [
+            ("pyrefly_0.0.0", True, stale),
+            ("pyrefly_0.0.1", True, time.time()),
+            ("pyrefly_unmarked", False, stale),
+        ]:
+            (cache_dir / name / "ab").mkdir(parents=True)
+            if marked:
+                (cache_dir / name / _CACHE_MARKER).touch()
+                os.utime(cache_dir / name / _CACHE_MARKER, (last_used, last_used))
+            os.utime(cache_dir / name, (last_used, last_used))
+        
+        analyzer = PyreflyAnalyzer(cache_dir=str(cache_dir))
+        analyzer.pyrefly_version = "pyrefly 0.0.2"
         with patch.object(analyzer, 'run_pyrefly_command') as mock_cmd:
-            mock_cmd.return_value = {
-                "success": False,
-                "stderr": "File not found",
-                "error": "File not found"
-            }
+            mock_cmd.side_effect = fake_run()
+            await analyzer.analyze_file(str(file_path))
+        
+        assert sorted(p.name for p in cache_dir.iterdir()) == [
+            "pyrefly_0.0.1", "pyrefly_0.0.2", "pyrefly_unmarked"
+        ]
+        assert (cache_dir / "pyrefly_0.0.2" / _CACHE_MARKER).exists()
+    
+    async def test_empty_cache_dir_disables_disk_cache(self, tmp_path, monkeypatch):
+        """Test that cache_dir="" disables the disk cache, as the environment variable does."""
+        monkeypatch.setenv("PYREFLY_AUTOTYPE_CACHE_DIR", str(tmp_path / "default"))
+        
+        assert PyreflyAnalyzer(cache_dir="")._cache.directory is None
+        assert PyreflyAnalyzer()._cache.directory == str(tmp_path / "default")
+    
+    async def test_get_project_context_check_only(self, analyzer_with_mock):
+        """Test that project context only runs `pyrefly check`, never autotype."""
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in ("a.py", "b.py"):
+                with open(os.path.join(tmp, name), "w") as f:
+                    f.write(f"# {name}\n")
+            os.mkdir(os.path.join(tmp, "__pycache__"))
+            with open(os.path.join(tmp, "__pycache__", "skipped.py"), "w") as f:
+                f.write("")
+            
+            analyzer, mock_cmd = analyzer_with_mock
+            mock_cmd.side_effect = fake_run("0 errors")
+            
+            context = await analyzer.get_project_context(tmp)
+            
+            mock_cmd.assert_called_once()
+            assert "check" in mock_cmd.call_args.args[0]
+            assert "autotype" not in mock_cmd.call_args.args[0]
+            assert sorted(os.path.basename(p) for p in context["python_files"]) == ["a.py", "b.py"]
+            assert context["analysis_summary"] == {"output": "0 errors", "total_files": 2}
+
+
+async def test_batcher_coalesces_requests():
+    """Test that concurrent analyze requests are served by one batch."""
+    analyzer = PyreflyAnalyzer()
+    calls = []
+    
+    async def fake_analyze_files(paths):
+        calls.append(list(paths))
+        return {path: {"file_path": path} for path in paths}
+    
+    analyzer.analyze_files = fake_analyze_files
+    batcher = AnalysisBatcher(analyzer, batch_size=8, debounce=0.01)
+    
+    results = await asyncio.gather(*(batcher.analyze(f"f{i}.py") for i in range(3)))
+    await batcher.aclose()
+    
+    assert [r["file_path"] for r in results] == ["f0.py", "f1.py", "f2.py"]
+    assert calls == [["f0.py", "f1.py", "f2.py"]]
 
-            result = await analyzer.analyze_file("nonexistent.py")
 
-            assert "error" in result
-            assert result["file_path"] == "nonexistent.py"
+def test_batch_size_from_env(monkeypatch):
+    """Test that the batch size setting is validated once, at import."""
+    for raw, expected in (("8", 8), ("0", 1), ("-1", 1)):
+        monkeypatch.setenv("PYREFLY_AUTOTYPE_BATCH_SIZE", raw)
+        assert _batch_size_from_env() == expected
+    
+    monkeypatch.delenv("PYREFLY_AUTOTYPE_BATCH_SIZE")
+    assert _batch_size_from_env() == 64
+    
+    monkeypatch.setenv("PYREFLY_AUTOTYPE_BATCH_SIZE", "lots")
+    with pytest.raises(ValueError, match="PYREFLY_AUTOTYPE_BATCH_SIZE"):
+        _batch_size_from_env()
 
 
 async def test_utility_functions():
     """Test utility functions."""
     
     # Test autotype via analyzer command success
-    with patch('subprocess.run') as mock_run:
-        mock_result = MagicMock()
-        mock_result.returncode = 0
-        mock_result.stdout = "Types added successfully"
-        mock_result.stderr = ""
-        mock_run.return_value = mock_result
+    with patch('asyncio.create_subprocess_exec') as mock_exec:
+        mock_exec.return_value = make_process(0, "Types added successfully")
         
         analyzer = PyreflyAnalyzer()
         result = await analyzer.run_pyrefly_command(["uv", "run", "pyrefly", "autotype", "test.py"])
@@ -83,12 +302,8 @@ async def test_utility_functions():
         assert result["stdout"] == "Types added successfully"
     
     # Test run_pyrefly_check_success
-    with patch('subprocess.run') as mock_run:
-        mock_result = MagicMock()
-        mock_result.returncode = 0
-        mock_result.stdout = "Success: no issues found"
-        mock_result.stderr = ""
-        mock_run.return_value = mock_result
+    with patch('asyncio.create_subprocess_exec') as mock_exec:
+        mock_exec.return_value = make_process(0, "Success: no issues found")
         
         result = await run_pyrefly_check("test.py")
         
@@ -96,108 +311,132 @@ async def test_utility_functions():
         assert "no issues found" in result["output"]
 
 
+async def test_analyze_file_streams_output():
+    """Test that streamed analysis parses every line but keeps a bounded tail."""
+    lines = [f"Function f{i} needs type annotations" for i in range(1000)]
+    
+    with patch('asyncio.create_subprocess_exec') as mock_exec:
+        mock_exec.return_value = make_process(0, "\n".join(lines) + "\n")
+        
+        analyzer = PyreflyAnalyzer()
+        analysis = await analyzer.analyze_file("streamed.py")
+        
+        assert analysis["functions_needing_types"] == lines
+        assert len(analysis["pyrefly_output"]) < len("\n".join(lines))
+        assert analysis["pyrefly_output"].endswith(lines[-1] + "\n")
+
+
+async def test_analysis_matches_kind_words_in_any_order():
+    """Test that "type" may come before the kind word and that function wins ties."""
+    lines = [
+        "Missing return type for function f",
+        "Type annotation missing for function foo",
+        "Variable x has function type",
+        "Type of variable y is unknown",
+        "Function g is fine",
+    ]
+    
+    with patch('asyncio.create_subprocess_exec') as mock_exec:
+        mock_exec.return_value = make_process(0, "\n".join(lines))
+        
+        analyzer = PyreflyAnalyzer()
+        analysis = await analyzer.analyze_file("order.py")
+        
+        assert analysis["functions_needing_types"] == lines[:3]
+        assert analysis["variables_needing_types"] == ["Type of variable y is unknown"]
+
+
+async def test_analyze_file_streams_long_lines():
+    """Test that streamed output lines longer than the read size are kept whole."""
+    long_line = "Function f needs type annotations " + "x" * 100_000
+    
+    with patch('asyncio.create_subprocess_exec') as mock_exec:
+        mock_exec.return_value = make_process(0, long_line + "\nVariable y needs a type")
+        
+        analyzer = PyreflyAnalyzer()
+        analysis = await analyzer.analyze_file("long.py")
+        
+        assert analysis["functions_needing_types"] == [long_line]
+        assert analysis["variables_needing_types"] == ["Variable y needs a type"]
+
+
+async def test_run_pyrefly_command_timeout():
+    """Test that a hung Pyrefly process is killed on timeout."""
+    proc = make_process(hangs=True)
+    
+    with patch('asyncio.create_subprocess_exec') as mock_exec:
+        mock_exec.return_value = proc
+        
+        analyzer = PyreflyAnalyzer()
+        result = await analyzer.run_pyrefly_command(["uv", "run", "pyrefly", "check", "test.py"], timeout=0.01)
+        
+        assert result["success"] is False
+        assert "timed out" in result["error"]
+        assert proc.kills == 1
+
+
+def test_cheap_backup():
+    """Test that backups keep the original content after it is rewritten."""
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, "module.py")
+        dst = src + ".backup"
+        with open(src, "w") as f:
+            f.write("x = 1\n")
+        
+        assert _cheap_backup(src, dst) in ("reflink", "copy")
+        
+        with open(src, "w") as f:
+            f.write("x: int = 1\n")
+        with open(dst) as f:
+            assert f.read() == "x = 1\n"
+
+
+async def test_run_pyrefly_command_cancelled():
+    """Test that cancelling a Pyrefly call kills the subprocess."""
+    proc = make_process(hangs=True)
+    
+    with patch('asyncio.create_subprocess_exec') as mock_exec:
+        mock_exec.return_value = proc
+        
+        analyzer = PyreflyAnalyzer()
+        task = asyncio.create_task(
+            analyzer.run_pyrefly_command(["uv", "run", "pyrefly", "check", "test.py"])
+        )
+        await asyncio.sleep(0.01)
+        task.cancel()
+        
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert proc.kills == 1
+
+
 async def test_integration_workflow():
     """Test a complete workflow from analysis to type addition."""
-    # Create temporary file with proper cleanup
-    temp_file = None
-    try:
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False) as f:
-            f.write("""
-def greet(name):
-    return f"Hello, {name}!"
-
-def add_numbers(a, b):
-    return a + b
-
-age = 25
-""")
-            f.flush()
-            temp_file = f.name
-        
-        # Mock all subprocess calls
-        with patch('subprocess.run') as mock_run:
-            # Mock Pyrefly analysis
-            mock_result = MagicMock()
-            mock_result.returncode = 0
-            mock_result.stdout = "Functions greet, add_numbers need type annotations"
-            mock_result.stderr = ""
-            mock_run.return_value = mock_result
-            
-            # Test analyze tool
-            analyzer = PyreflyAnalyzer()
-            analysis = await analyzer.analyze_file(temp_file)
-            
-            assert analysis["file_path"] == temp_file
-            assert "functions_needing_types" in analysis
-            
-            # Mock Pyrefly autotype
-            mock_result.stdout = "Types added successfully to " + temp_file
-            
-            # Test add types tool
-            result = await analyzer.run_pyrefly_command(["uv", "run", "pyrefly", "autotype", temp_file])
-            assert result["success"] is True
-            
-            # Mock Pyrefly check
-            mock_result.stdout = "Success: no issues found"
-            
-            # Test type check tool
-            pyrefly_result = await run_pyrefly_check(temp_file)
-            assert pyrefly_result["success"] is True
-            
-    finally:
-        # Clean up with better error handling
-        if temp_file and os.path.exists(temp_file):
-            try:
-                os.unlink(temp_file)
-            except (OSError, PermissionError):
-                # On Windows, sometimes files are still locked
-                # Try again after a short delay
-                import time
-                time.sleep(0.1)
-                try:
-                    os.unlink(temp_file)
-                except (OSError, PermissionError):
-                    # If we still can't delete it, just leave it
-                    # The OS will clean it up eventually
-                    pass
-
-
-async def run_all_tests():
-    """Run all tests."""
-    print("Running Pyrefly MCP Server Tests...")
-    
-    # Test PyreflyAnalyzer
-    test_analyzer = TestPyreflyAnalyzer()
-    
-    try:
-        await test_analyzer.test_analyze_file_success()
-        print("✓ test_analyze_file_success passed")
-    except Exception as e:
-        print(f"✗ test_analyze_file_success failed: {e}")
-    
-    try:
-        await test_analyzer.test_analyze_file_error()
-        print("✓ test_analyze_file_error passed")
-    except Exception as e:
-        print(f"✗ test_analyze_file_error failed: {e}")
-    
-    # Test utility functions
-    try:
-        await test_utility_functions()
-        print("✓ test_utility_functions passed")
-    except Exception as e:
-        print(f"✗ test_utility_functions failed: {e}")
-    
-    # Test integration workflow
-    try:
-        await test_integration_workflow()
-        print("✓ test_integration_workflow passed")
-    except Exception as e:
-        print(f"✗ test_integration_workflow failed: {e}")
-    
-    print("Test run complete!")
-
-
-if __name__ == "__main__":
-    # Run basic tests
-    asyncio.run(run_all_tests())
+    # Every subprocess call is mocked, so a virtual path is enough
+    temp_file = f"/virtual/test_{uuid4()}.py"
+    
+    # Mock all subprocess calls
+    with patch('asyncio.create_subprocess_exec') as mock_exec:
+        # Mock Pyrefly analysis
+        mock_exec.return_value = make_process(0, "Functions greet, add_numbers need type annotations")
+        
+        # Test analyze tool
+        analyzer = PyreflyAnalyzer()
+        analysis = await analyzer.analyze_file(temp_file)
+        
+        assert analysis["file_path"] == temp_file
+        assert "functions_needing_types" in analysis
+        
+        # Mock Pyrefly autotype
+        mock_exec.return_value = make_process(0, "Types added successfully to " + temp_file)
+        
+        # Test add types tool
+        result = await analyzer.run_pyrefly_command(["uv", "run", "pyrefly", "autotype", temp_file])
+        assert result["success"] is True
+        
+        # Mock Pyrefly check
+        mock_exec.return_value = make_process(0, "Success: no issues found")
+        
+        # Test type check tool
+        pyrefly_result = await run_pyrefly_check(temp_file)
+        assert pyrefly_result["success"] is True